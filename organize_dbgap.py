@@ -1,12 +1,19 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3.6
 
 import os
 import sys
 import shutil  # file system utilities
 import re  # regular expressions
 from argparse import ArgumentParser
-import subprocess  # for system commands - in this case, only diff
+import subprocess  # for system commands
+import hashlib  # for comparing file contents
+import gzip
+import tarfile
 import errno
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from stat import S_IRUSR, S_IXUSR, S_IRGRP, S_IXGRP
 from datetime import datetime
 import pandas as pd
@@ -14,13 +21,41 @@ import pandas as pd
 __version__ = 1.4
 
 # regular expression matchers for various kinds of dbgap files
-dbgap_re_dict = {
+# patterns are compiled once at import time, since they are matched against every file in the download;
+# dbgap filenames are ASCII, so \d and \w only need to match ASCII characters
+dbgap_re_dict = {key: re.compile(value, re.ASCII) for key, value in {
     'data_dict': r'^(?P<dbgap_id>phs\d{6}\.v\d+?\.pht\d{6}\.v\d+?)\.(?P<base>.+?)\.data_dict(?P<extra>\w{0,}?)\.xml$',
     'phenotype': r'^(?P<dbgap_id>phs\d{6}\.v\d+?\.pht\d{6}\.v\d+?)\.p(\d+?)\.c(\d+?)\.(?P<base>.+?)\.(?P<consent_code>.+?)\.txt$',  # noqa
     'var_report': r'^(?P<dbgap_id>phs\d{6}\.v\d+?\.pht\d{6}\.v\d+?)\.p(\d+?)\.(?P<base>.+?)\.var_report(\w{0,}?)\.xml$',  # noqa
     'special': r'^(?P<dbgap_id>phs\d{6}\.v\d+?\.pht\d{6}\.v\d+?)\.p(\d+?)\.(.+?)\.MULTI.txt$'
+}.items()}
+
+# file types in dbgap_re_dict that can match each file extension; all dbgap files also start with 'phs'
+# if a filename matches more than one pattern, the last matching pattern in dbgap_re_dict wins, so the types are
+# listed in reverse dbgap_re_dict order and the first match is used; e.g. a .c1.Subject.MULTI.txt file that also fits
+# the phenotype pattern is 'special'
+dbgap_extension_dict = {
+    'txt': ('special', 'phenotype'),
+    'xml': ('var_report', 'data_dict'),
 }
 
+
+# literal text that must appear in a filename for each pattern in dbgap_re_dict to match; a pattern is
+# only tried if its literal is present, so most files need a single regex match to be classified
+dbgap_literal_dict = {
+    'phenotype': '',
+    'special': '.MULTI',
+    'data_dict': '.data_dict',
+    'var_report': '.var_report',
+}
+
+# regular expression matchers for the input directory name parsed by parse_input_directory
+prerelease_directory_re = re.compile(r'^ProcessedPheno(?P<date>201\d{5})$', re.ASCII)
+release_directory_re = re.compile(r'(?P<phs>phs\d{6})\.(?P<v>v\d+)$', re.ASCII)
+
+# file content digests computed by _get_digest, keyed by (path, size, modification time)
+_digest_cache = {}
+
 # Some notes:
 # The var_reports and data dictionaries pertain to a single participant set number; they are the same across consent
 # groups. We only need to link 1 var_report and 1 data_dict for each phenotype dataset.
@@ -29,23 +64,34 @@ dbgap_re_dict = {
 class DbgapFile(object):
     """Class to hold information about files downloaded from dbgap.
     """
-    def __init__(self, file_path, check_exists=True):
+    # one instance is made for every downloaded file, so avoid a per-instance __dict__
+    __slots__ = ('full_path', 'basename', 'file_type', 'match', 'dbgap_id')
+
+    def __init__(self, file_path, check_exists=True, basename=None):
         """Constructor function for DbgapFile instances.
 
         Arguments:
 
         file_path: full path to a file downloaded from dbgap
+
+        Keyword arguments:
+
+        check_exists: if True, raise a FileNotFoundError if file_path does not exist
+        basename: basename of file_path, if already known (eg from os.DirEntry.name)
         """
         self.full_path = os.path.abspath(file_path)
 
         if check_exists and not os.path.exists(self.full_path):
             raise FileNotFoundError(self.full_path + " does not exist")
 
-        self.basename = os.path.basename(file_path)
+        if basename is None:
+            basename = os.path.basename(file_path)
+        self.basename = basename
 
         # these will be set in the set_file_type class method
         self.file_type = None  # will store the file type
         self.match = None  # will store the regular expression re.match object
+        self.dbgap_id = None  # will store the dbgap_id capture group from match, ie phs??????.v?.pht??????.v?
 
         # auto-set the file type
         self._set_file_type()  # possibilities are 'phenotype', 'var_report', 'data_dict'
@@ -55,48 +101,186 @@ class DbgapFile(object):
         return self.full_path
 
     def _set_file_type(self, re_dict=dbgap_re_dict):
-        """Function to set the file_type of a DbgapFile object, based on regular expression patterns"""
+        """Function to set the file_type of a DbgapFile object, based on regular expression patterns
 
-        for key, value in re_dict.items():
-            match = re.match(value, self.basename)
+        re_dict values may be compiled patterns or pattern strings. If a file matches more than one
+        pattern, the first matching key in re_dict is used."""
+
+        if re_dict is dbgap_re_dict:
+            file_type, match = _classify(self.basename)
+            if match is not None:
+                self.file_type = file_type
+                self.match = match
+                self.dbgap_id = match.group('dbgap_id')
+            return
+
+        for key, pattern in _compile_re_dict(tuple(re_dict.items())):
+            match = pattern.match(self.basename)
             if match is not None:
                 self.file_type = key
                 self.match = match
+                self.dbgap_id = match.groupdict().get('dbgap_id')
+                break
+
+
+@lru_cache(maxsize=128)
+def _compile_re_dict(re_items):
+    """Return a tuple of (key, compiled pattern) pairs for a tuple of re_dict items, keeping their order.
+    Results are cached, so a caller-supplied re_dict of pattern strings is only compiled once."""
+    return tuple((key, re.compile(pattern) if isinstance(pattern, str) else pattern) for key, pattern in re_items)
+
+
+@lru_cache(maxsize=None)
+def _classify(basename):
+    """Classify a file name using the patterns in dbgap_re_dict.
+
+    Results are cached, since the same file names are repeated across consent group downloads.
+
+    Returns:
+    a (file_type, match) tuple, or (None, None) if the file name does not match any pattern
+    """
+    # rule out patterns with cheap string checks before running any regular expressions
+    if not basename.startswith('phs'):
+        return None, None
+    for file_type in dbgap_extension_dict.get(basename.rpartition('.')[2], ()):
+        if dbgap_literal_dict[file_type] in basename:
+            match = dbgap_re_dict[file_type].match(basename)
+            if match is not None:
+                return file_type, match
+    return None, None
+
+
+def _scan_directory(directory):
+    """Scan a single directory with os.scandir.
+
+    Returns:
+    a tuple of (list of subdirectory paths, list of os.DirEntry objects for non-directory entries).
+    As with os.walk, symlinks to directories are not included in either list.
+    """
+    subdirectories = []
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirectories.append(entry.path)
+            else:
+                files.append(entry)
+    return subdirectories, files
+
+
+def _walk_files(directory, max_workers=8):
+    """Generator yielding an os.DirEntry for each non-directory entry in a directory tree.
+
+    Uses os.scandir directly, so the file type of each entry comes from the directory listing
+    rather than a separate stat call. The directories at each level of the tree are scanned in a
+    thread pool, which overlaps the directory listing latency on network file systems.
+    """
+    directories = [directory]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while directories:
+            subdirectories = []
+            for scanned_subdirectories, files in executor.map(_scan_directory, directories):
+                subdirectories.extend(scanned_subdirectories)
+                for entry in files:
+                    yield entry
+            directories = subdirectories
 
 
 def get_file_list(directory):
     """Returns a list of DbgapFile objects, one for each file in the downloaded directory tree.
     The DbgapFile objects will already have been classified with their file_type attribute set.
+    Existence is not re-checked, since each file was just found by scanning its directory.
     """
     file_list = []
-    for root, dirs, files in os.walk(directory):
-        for name in files:
-            full_path = os.path.join(root, name)
-
-            dbgap_file = DbgapFile(full_path)
+    for entry in _walk_files(directory):
+        dbgap_file = DbgapFile(entry.path, check_exists=False, basename=entry.name)
 
-            file_list.append(dbgap_file)
+        file_list.append(dbgap_file)
 
     return file_list
 
 
+def _get_digest(path):
+    """Return the SHA-256 digest of a file's contents.
+
+    Digests are cached by path, size, and modification time, so each file is only read once
+    no matter how many file sets it is compared in."""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _digest_cache:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _digest_cache[key] = digest.digest()
+    return _digest_cache[key]
+
+
 def _check_diffs(dbgap_file_subset):
-    """Run a unix diff on a set of files to make sure that they are all the same.
+    """Compare the contents of a set of files to make sure that they are all the same.
 
+    File sizes are compared first, so files that differ in size are never read. Otherwise the files
+    are hashed in a thread pool, since reading them is I/O bound.
     If they are not the same, a ValueError is raised."""
     filename_a = dbgap_file_subset[0].full_path
+    paths = [f.full_path for f in dbgap_file_subset]
 
-    for i in range(1, len(dbgap_file_subset)):
-        filename_b = dbgap_file_subset[i].full_path
-        cmd = 'diff {file1} {file2}'.format(file1=filename_a, file2=filename_b)
-        try:
-            out = subprocess.check_output(cmd, shell=True)
-        except subprocess.CalledProcessError:
+    if len(paths) == 1:
+        return
+    sizes = [os.stat(path).st_size for path in paths]
+    for filename_b, size in zip(paths[1:], sizes[1:]):
+        if size != sizes[0]:
             raise ValueError('files are expect to be the same but are different: {file_a}, {file_b}'.format(
                 file_a=filename_a, file_b=filename_b))
+    with ThreadPoolExecutor(max_workers=min(32, len(paths))) as executor:
+        digests = list(executor.map(_get_digest, paths))
+
+    for filename_b, digest in zip(paths[1:], digests[1:]):
+        if digest != digests[0]:
+            raise ValueError('files are expect to be the same but are different: {file_a}, {file_b}'.format(
+                file_a=filename_a, file_b=filename_b))
+
+
+def _group_by_file_type(dbgap_files):
+    """Group a list of DbgapFile objects by file type, in a single pass.
+
+    Arguments:
 
+    dbgap_files: list of DbgapFile objects returned from get_file_list
+
+    Returns:
+
+    a defaultdict(list) mapping each file_type to a list of DbgapFile objects.
+    Files that were not classified are under the key None.
+    """
+    files_by_type = defaultdict(list)
+    for f in dbgap_files:
+        files_by_type[f.file_type].append(f)
+    return files_by_type
+
+
+def _index_file_list(dbgap_files):
+    """Index a list of DbgapFile objects by file type and dbgap_id.
+
+    Arguments:
+
+    dbgap_files: list of DbgapFile objects returned from get_file_list
+
+    Returns:
 
-def _get_file_match(dbgap_files, dbgap_file_to_match, match_type, check_diffs=True, must_exist=True):
+    a defaultdict(list) mapping (file_type, dbgap_id) tuples to lists of DbgapFile objects.
+    Files that were not classified are not included.
+    """
+    file_index = defaultdict(list)
+    for f in dbgap_files:
+        if f.file_type is not None:
+            file_index[(f.file_type, f.dbgap_id)].append(f)
+    return file_index
+
+
+def _get_file_match(dbgap_files, dbgap_file_to_match, match_type, check_diffs=True, must_exist=True,
+                    file_index=None):
     """For a given DbgapFile, find the matcing var_report DbgapFile.
 
     Arguments:
@@ -107,6 +291,8 @@ def _get_file_match(dbgap_files, dbgap_file_to_match, match_type, check_diffs=Tr
 
     Optional arguments:
     check_diffs: if True, check that all matching var_report files are the same.
+    file_index: index of dbgap_files returned from _index_file_list; pass this when finding matches
+                for many files so that the list is only indexed once.
 
     Files are matched based on file_type (to match match_type) and the
     dgap_id capture group from the regular expressions used to classify files.
@@ -116,13 +302,11 @@ def _get_file_match(dbgap_files, dbgap_file_to_match, match_type, check_diffs=Tr
 
     the DbgapFile object that has the same dbgap_id as the dbgap_file_to_match and correct file_type.
     """
-    dbgap_id_to_match = dbgap_file_to_match.match.groupdict()['dbgap_id']
+    if file_index is None:
+        file_index = _index_file_list(dbgap_files)
 
-    matches = []
-    for f in dbgap_files:
-        if f.file_type == match_type:
-            if f.match.groupdict()['dbgap_id'] == dbgap_id_to_match:
-                matches.append(f)
+    dbgap_id_to_match = dbgap_file_to_match.dbgap_id
+    matches = file_index.get((match_type, dbgap_id_to_match), [])
 
     if len(matches) == 0:
         if not must_exist:
@@ -136,7 +320,31 @@ def _get_file_match(dbgap_files, dbgap_file_to_match, match_type, check_diffs=Tr
     return matches[0]
 
 
-def _get_special_file_set(dbgap_files, pattern='Subject'):
+def _group_special_files(dbgap_files, patterns=('Subject', 'Sample', 'Pedigree')):
+    """Group "special" files by the pattern found in their file name, in a single pass over dbgap_files.
+
+    Arguments:
+
+    dbgap_files: list of DbgapFile objects returned from get_file_list
+
+    Optional arguments:
+
+    patterns: the patterns in the file name to group by
+
+    Returns:
+    a dictionary mapping each pattern to the list of special DbgapFiles whose basename contains it
+    """
+    special_files = {pattern: [] for pattern in patterns}
+    for f in dbgap_files:
+        if f.file_type != 'special':
+            continue
+        for pattern in patterns:
+            if pattern in f.basename:
+                special_files[pattern].append(f)
+    return special_files
+
+
+def _get_special_file_set(dbgap_files, pattern='Subject', special_files=None, file_index=None):
     """Returns the file_set for "special" files: ie, the Subject, Sample, and Pedigree files
 
     Arguments:
@@ -146,6 +354,9 @@ def _get_special_file_set(dbgap_files, pattern='Subject'):
     Optional arguments:
 
     pattern: the pattern in the file name to identify which file to find (ie, 'Subject' to find the subject files)
+    special_files: dictionary returned by _group_special_files, which must include pattern as a key;
+                   pass this when finding several special file sets so that dbgap_files is only scanned once
+    file_index: index of dbgap_files returned from _index_file_list
 
     Returns:
     file_set: a dictionary with keys
@@ -157,7 +368,9 @@ def _get_special_file_set(dbgap_files, pattern='Subject'):
     across consent groups, this function only returns one data_dict and one var_report for
     each phenotype file set.
     """
-    special_files = [f for f in dbgap_files if f.file_type == 'special' and pattern in f.basename]
+    if special_files is None:
+        special_files = _group_special_files(dbgap_files, patterns=(pattern, ))
+    special_files = special_files[pattern]
 
     if len(special_files) == 0:
         return None
@@ -166,8 +379,11 @@ def _get_special_file_set(dbgap_files, pattern='Subject'):
     _check_diffs(special_files)
 
     # get the var_report and data_dictionary to go with the subject file
-    var_report = _get_file_match(dbgap_files, special_files[0], 'var_report', must_exist=False)
-    data_dict = _get_file_match(dbgap_files, special_files[0], 'data_dict')
+    if file_index is None:
+        file_index = _index_file_list(dbgap_files)
+    var_report = _get_file_match(dbgap_files, special_files[0], 'var_report', must_exist=False,
+                                 file_index=file_index)
+    data_dict = _get_file_match(dbgap_files, special_files[0], 'data_dict', file_index=file_index)
 
     # return the whole set
     file_set = {'data_files': [special_files[0]],
@@ -176,13 +392,17 @@ def _get_special_file_set(dbgap_files, pattern='Subject'):
     return file_set
 
 
-def _get_phenotype_file_sets(dbgap_files):
+def _get_phenotype_file_sets(dbgap_files, file_index=None):
     """Returns the file_set for phenotype files: ie, .txt files that are not Subject, Sample, and Pedigree files
 
     Arguments:
 
     dbgap_files: list of DbgapFile objects returned from get_file_list
 
+    Optional arguments:
+
+    file_index: index of dbgap_files returned from _index_file_list
+
     Returns:
     file_set: a dictionary with keys
                 'data_files' (list DbgapFiles of length n, where n is the number of consent groups)
@@ -195,16 +415,19 @@ def _get_phenotype_file_sets(dbgap_files):
 
     """
 
-    phenotype_files = [f for f in dbgap_files if f.file_type == 'phenotype']
-    # get the set of unique dbgap_ids
-    dbgap_ids = set([f.match.groupdict()['dbgap_id'] for f in phenotype_files])
+    # the index groups phenotype files by dbgap_id in a single pass, and also makes finding
+    # each set's var_report and data_dict a lookup rather than a scan
+    if file_index is None:
+        file_index = _index_file_list(dbgap_files)
 
     phenotype_file_sets = []
-    for dbgap_id in dbgap_ids:
+    for (file_type, dbgap_id), matching_files in file_index.items():
+        if file_type != 'phenotype':
+            continue
 
-        matching_files = [f for f in phenotype_files if f.match.groupdict()['dbgap_id'] == dbgap_id]
-        var_report = _get_file_match(dbgap_files, matching_files[0], 'var_report', must_exist=False)
-        data_dict = _get_file_match(dbgap_files, matching_files[0], 'data_dict')
+        var_report = _get_file_match(dbgap_files, matching_files[0], 'var_report', must_exist=False,
+                                     file_index=file_index)
+        data_dict = _get_file_match(dbgap_files, matching_files[0], 'data_dict', file_index=file_index)
         this_set = {'data_files': matching_files,
                     'var_report': var_report,
                     'data_dict': data_dict
@@ -220,12 +443,12 @@ def _get_phenotype_file_sets(dbgap_files):
             msg = 'phenotype file set should have {n} data files but only has: {filenames}'.format(
                 filenames=', '.join(basenames), n=n_phenotype_files)
             raise ValueError(msg)
-        for y in basenames:
-            if basenames.count(y) > 1:
-                msg = 'duplicate phenotype files detected for filename {name}'.format(
-                    name=y
-                )
-                raise RuntimeError(msg)
+        duplicates = [name for name, count in Counter(basenames).items() if count > 1]
+        if len(duplicates) > 0:
+            msg = 'duplicate phenotype files detected for filename {name}'.format(
+                name=duplicates[0]
+            )
+            raise RuntimeError(msg)
 
     return phenotype_file_sets
 
@@ -245,24 +468,59 @@ def _check_symlink(symlink_path):
     return os.path.exists(symlink_path)
 
 
-def _make_symlink(dbgap_file):
-    """Make (relative path) symlinks to a DbgapFile object's path in the current directory.
+@lru_cache(maxsize=None)
+def _get_relative_directory(source_directory, directory):
+    """Return the path of source_directory relative to directory.
+
+    Both arguments should be absolute paths. Results are cached, since all the files from one
+    download directory are linked into the same organized directory.
+    """
+    return os.path.relpath(source_directory, directory)
+
+
+@contextmanager
+def _open_directory(directory):
+    """Context manager yielding a file descriptor for a directory, for use as a dir_fd argument."""
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        yield dir_fd
+    finally:
+        os.close(dir_fd)
+
+
+def _make_symlink(dbgap_file, directory='.', dir_fd=None):
+    """Make (relative path) symlinks to a DbgapFile object's path in a directory.
 
     Arguments:
 
     dbgap_file: a DbgapFile object whose path will be used to make a symlink
-    """
-    path = os.path.relpath(dbgap_file.full_path)
-    if not os.path.exists(path):
-        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
-    os.symlink(path, dbgap_file.basename)
+    Keyword arguments:
 
-    if not _check_symlink(dbgap_file.basename):
-        raise FileNotFoundError(errno.ENOENT, os.strerr(errno.ENOENT), dbgap_file.basename)
+    directory: directory to make the symlink in; defaults to the current directory
+    dir_fd: open file descriptor for directory from _open_directory; pass this when making many
+            symlinks in the same directory so the directory path is not resolved for each one
+    """
+    source_directory, name = os.path.split(dbgap_file.full_path)
+    # _make_symlink_set already passes an absolute directory, so only resolve it here when needed
+    if not os.path.isabs(directory):
+        directory = os.path.abspath(directory)
+    relative_directory = _get_relative_directory(source_directory, directory)
+    path = name if relative_directory == os.curdir else os.path.join(relative_directory, name)
+
+    symlink_path = os.path.join(directory, dbgap_file.basename)
+    if dir_fd is None:
+        os.symlink(path, symlink_path)
+    else:
+        os.symlink(path, dbgap_file.basename, dir_fd=dir_fd)
 
+    # checking the symlink follows it, so this also checks that the file itself exists
+    if not _check_symlink(symlink_path):
+        os.remove(symlink_path)
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), dbgap_file.full_path)
 
-def _make_symlink_set(file_set):
+
+def _make_symlink_set(file_set, directory='.', dir_fd=None):
     """Make symlinks for a set of DbgapFile objects, ie, all the data_files and their
     corresponding data_dict file and var_report file.
 
@@ -272,52 +530,57 @@ def _make_symlink_set(file_set):
               either the dictionary returned by _get_special_file_set or one
               element of the list returned by _getphenotype_file_sets or
 
+    Keyword arguments:
+
+    directory: directory to make the symlinks in; defaults to the current directory
+    dir_fd: open file descriptor for directory from _open_directory
+
     One symlink for each of the 'data_files' is made, plus one for the var_report and data_dict files
     """
+    # resolve the directory once, so that relpath does not call os.getcwd for every symlink
+    directory = os.path.abspath(directory)
     # link the actual data
     for f in file_set['data_files']:
-        _make_symlink(f)
+        _make_symlink(f, directory=directory, dir_fd=dir_fd)
     # link the var_report
     if file_set['var_report'] is not None:
-        _make_symlink(file_set['var_report'])
+        _make_symlink(file_set['var_report'], directory=directory, dir_fd=dir_fd)
     else:
         print("missing var_report for file {file}".format(file=file_set['data_dict'].basename))
     # link the data dictionary
-    _make_symlink(file_set['data_dict'])
+    _make_symlink(file_set['data_dict'], directory=directory, dir_fd=dir_fd)
 
 
-def _make_symlinks(organized_directory, subject_file_set, pedigree_file_set, sample_file_set, phenotype_file_sets, nfiles=None):  # noqa
+def _make_symlinks(organized_directory, subject_file_set, pedigree_file_set, sample_file_set, phenotype_file_sets, nfiles=None, max_workers=8):  # noqa
     """Function to generate symlinks for a set of dbgap files.
-    """
-    orig_directory = os.getcwd()
 
-    if not os.path.exists(organized_directory):
-        os.mkdir(organized_directory)
-    os.chdir(organized_directory)
+    Symlinks are made relative to directory file descriptors, so the working directory is not changed.
+    max_workers is the number of threads used to make the phenotype file symlinks.
+    """
+    organized_directory = os.path.abspath(organized_directory)
 
     # special files first
-    if not os.path.exists("Subjects"):
-        os.mkdir("Subject")
-    os.chdir("Subject")
-
-    _make_symlink_set(subject_file_set)
-    _make_symlink_set(sample_file_set)
-    if pedigree_file_set is not None:
-        _make_symlink_set(pedigree_file_set)
-
-    os.chdir("..")
+    subject_directory = os.path.join(organized_directory, "Subject")
+    os.makedirs(subject_directory, exist_ok=True)
+    with _open_directory(subject_directory) as dir_fd:
+        _make_symlink_set(subject_file_set, directory=subject_directory, dir_fd=dir_fd)
+        _make_symlink_set(sample_file_set, directory=subject_directory, dir_fd=dir_fd)
+        if pedigree_file_set is not None:
+            _make_symlink_set(pedigree_file_set, directory=subject_directory, dir_fd=dir_fd)
 
     # phenotype files
-    if not os.path.exists("Phenotypes"):
-        os.mkdir("Phenotypes")
-    os.chdir("Phenotypes")
-
-    # make phenotype file symlinks
-    tmp = phenotype_file_sets[:nfiles]
-    for phenotype_file_set in tmp:
-        _make_symlink_set(phenotype_file_set)
+    phenotype_directory = os.path.join(organized_directory, "Phenotypes")
+    os.makedirs(phenotype_directory, exist_ok=True)
 
-    os.chdir(orig_directory)
+    # make phenotype file symlinks; os.symlink releases the GIL, so the sets are linked in a thread pool
+    with _open_directory(phenotype_directory) as dir_fd:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tmp = phenotype_file_sets[:nfiles]
+            futures = [executor.submit(_make_symlink_set, phenotype_file_set, directory=phenotype_directory,
+                                       dir_fd=dir_fd)
+                       for phenotype_file_set in tmp]
+            for future in futures:
+                future.result()
 
 
 def decrypt(directory, decrypt_path='/projects/resources/software/apps/sratoolkit/vdb-decrypt'):
@@ -331,30 +594,24 @@ def decrypt(directory, decrypt_path='/projects/resources/software/apps/sratoolki
 
     decrypt_path: path to sratoolkit's vdb-decrypt binary
     """
-    # get original directory
-    original_directory = os.getcwd()
     # need to be in the dbgap workspace directory to actually do the decryption
-    os.chdir(directory)
-    # system call to the decrypt binary
-    subprocess.check_call('{vdb} -q .'.format(vdb=decrypt_path), shell=True)
-    os.chdir(original_directory)
+    # call the decrypt binary directly, without a shell
+    subprocess.check_call([decrypt_path, '-q', '.'], cwd=directory)
 
 
 def _check_consent_groups(subject_file_set, phenotype_file_sets, consent_variable=None):
 
-    # Check for the number of header rows. They start with #.
-    n_skip = 0
-    done = False
+    # Skip the header rows, which start with #, and then parse the rest of the file from the same handle
+    # so that the subject file is only read once.
     with open(subject_file_set['data_files'][0].full_path) as f:
-        while not done:
+        position = f.tell()
+        line = f.readline()
+        while line.startswith('#') or (line != '' and line.rstrip() == ''):
+            position = f.tell()
             line = f.readline()
-            if line.startswith('#') or line.rstrip() == '':
-                n_skip += 1
-            else:
-                done = True
-    # Get the number of unique consent groups from the subject file.
-    subj_file = subject_file_set['data_files'][0].full_path
-    subj = pd.read_csv(subj_file, delimiter='\t', dtype=str, index_col=False, skiprows=n_skip)
+        f.seek(position)
+        # Get the number of unique consent groups from the subject file.
+        subj = pd.read_csv(f, delimiter='\t', dtype=str, index_col=False)
     # Figure out which column to use for the consent values.
     if consent_variable is None:
         consent_values = subj.iloc[:, 2]
@@ -367,13 +624,10 @@ def _check_consent_groups(subject_file_set, phenotype_file_sets, consent_variabl
             )
             raise KeyError(msg)
 
-    unique_consent_values = set(consent_values.unique())
     # Remove consent group 0
-    if '0' in unique_consent_values:
-        unique_consent_values.remove('0')
+    unique_consent_values = [x for x in pd.unique(consent_values) if x != '0']
     n_consent_groups = len(unique_consent_values)
-    expected_consent_groups = ['.c{consent}.'.format(consent=x) for x in unique_consent_values]
-    expected_consent_groups.sort()
+    expected_consent_groups = sorted('.c{consent}.'.format(consent=x) for x in unique_consent_values)
 
     # Check that all phenotype file sets have the expected number of consent values.
     for file_set in phenotype_file_sets:
@@ -408,16 +662,22 @@ def organize(raw_directory, organized_directory, link=False, nfiles=None, consen
     os.chdir(raw_directory)
 
     dbgap_files = get_file_list(raw_directory)
+    files_by_type = _group_by_file_type(dbgap_files)
 
     # find the special file sets
-    subject_file_set = _get_special_file_set(dbgap_files, pattern="Subject")
+    special_files = _group_special_files(files_by_type['special'])
+    file_index = _index_file_list(dbgap_files)
+    subject_file_set = _get_special_file_set(dbgap_files, pattern="Subject", special_files=special_files,
+                                             file_index=file_index)
     assert(subject_file_set is not None)
-    sample_file_set = _get_special_file_set(dbgap_files, pattern="Sample")
+    sample_file_set = _get_special_file_set(dbgap_files, pattern="Sample", special_files=special_files,
+                                            file_index=file_index)
     assert(sample_file_set is not None)
-    pedigree_file_set = _get_special_file_set(dbgap_files, pattern="Pedigree")
+    pedigree_file_set = _get_special_file_set(dbgap_files, pattern="Pedigree", special_files=special_files,
+                                              file_index=file_index)
 
     # find the phenotype file sets
-    phenotype_file_sets = _get_phenotype_file_sets(dbgap_files)
+    phenotype_file_sets = _get_phenotype_file_sets(dbgap_files, file_index=file_index)
 
     # Check that phenotype files exist for all consent groups.
     _check_consent_groups(subject_file_set, phenotype_file_sets, consent_variable=consent_variable)
@@ -428,19 +688,16 @@ def organize(raw_directory, organized_directory, link=False, nfiles=None, consen
                        nfiles=nfiles)
 
     # link files without matches in the "Other" directory
-    unsorted_files = [f for f in dbgap_files if f.file_type is None]
+    unsorted_files = files_by_type[None]
 
     if len(unsorted_files) > 0:
-        os.chdir(organized_directory)
-        if not os.path.exists("Other"):
-            os.mkdir("Other")
-        os.chdir("Other")
+        other_directory = os.path.join(os.path.abspath(organized_directory), "Other")
+        os.makedirs(other_directory, exist_ok=True)
 
-        for unsorted_file in unsorted_files:
-            if not os.path.exists(os.path.basename(unsorted_file.full_path)):
-                _make_symlink(unsorted_file)
-
-        os.chdir("..")
+        with _open_directory(other_directory) as dir_fd:
+            for unsorted_file in unsorted_files:
+                if not os.path.exists(os.path.join(other_directory, unsorted_file.basename)):
+                    _make_symlink(unsorted_file, directory=other_directory, dir_fd=dir_fd)
 
 
 def parse_input_directory(directory, prerelease=False):
@@ -459,8 +716,7 @@ def parse_input_directory(directory, prerelease=False):
     basename = os.path.basename(directory)
 
     if prerelease:
-        regex = re.compile(r'^ProcessedPheno(?P<date>201\d{5})$')
-        match = regex.match(basename)
+        match = prerelease_directory_re.match(basename)
         if match is not None:
             groups = match.groupdict()
             # this will fail with a ValueError if it is not a valid date
@@ -470,8 +726,7 @@ def parse_input_directory(directory, prerelease=False):
             raise ValueError('{basename} does not match expected string ProcessedPheno<date>'.format(
                 basename=basename))
     else:
-        regex = re.compile(r'(?P<phs>phs\d{6})\.(?P<v>v\d+)$')
-        match = regex.match(basename)
+        match = release_directory_re.match(basename)
         if match is not None:
             return(match.groupdict())
         else:
@@ -510,46 +765,145 @@ def create_final_directory(phs, version, out_path):
     return version_directory
 
 
-def copy_files(from_path, to_path):
+def _link_or_copy(src, dst):
+    """Hard link src to dst, falling back to a copy if they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _copy_file_range(src, dst):
+    """Copy src to dst with os.copy_file_range, so the data never passes through user space, and
+    filesystems that support it (e.g. XFS, Btrfs, NFS 4.2) can clone or copy it server-side.
+    Falls back to shutil.copy2 where copy_file_range is not available, or where it copies nothing,
+    since some filesystems report end of file at offset 0 instead of failing."""
+    try:
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            copied = 0
+            while True:
+                n_bytes = os.copy_file_range(f_in.fileno(), f_out.fileno(), 1024 * 1024 * 1024)
+                if n_bytes == 0:
+                    break
+                copied += n_bytes
+            size = os.fstat(f_in.fileno()).st_size
+    except (AttributeError, OSError):
+        copied = None
+    if not copied or copied != size:
+        shutil.copy2(src, dst)
+    else:
+        shutil.copystat(src, dst)
 
-    shutil.copytree(from_path, to_path)
 
+def copy_files(from_path, to_path, hardlink=False):
+    """Copy the from_path directory tree to to_path.
 
-def uncompress(directory):
-    """Uncompress a directory by walking the directory tree. Currently not guaranteed
-    to be recursive, i.e. does not uncompress a file that was previously in a tar archive.
+    Keyword arguments:
+    hardlink: if True, hard link files instead of copying them where possible, so that no file data
+              is duplicated. The linked files share permissions with the originals.
     """
-    rerun = False
-    # may need to be called recursively
-    # walk through the directory and find anything that needs to be uncompressed
-    for root, dirs, files in os.walk(directory):
-        for name in files:
-            # tar file
-            if name.endswith(".tar.gz"):
-                abspath = os.path.join(root, name)
-                cmd = 'tar -xzf {file} -C {directory}'.format(file=abspath, directory=root)
-                subprocess.check_call(cmd, shell=True)
-                # we don't want to save the tar archive
-                os.remove(abspath)
-                rerun = True
-            if name.endswith(".txt.gz"):
-                abspath = os.path.join(root, name)
-                cmd = 'gunzip {file}'.format(file=abspath)
-                subprocess.check_call(cmd, shell=True)
-
-    if rerun:
-        # recursion!
-        uncompress(directory)
+    if hardlink:
+        shutil.copytree(from_path, to_path, copy_function=_link_or_copy)
+    else:
+        shutil.copytree(from_path, to_path, copy_function=_copy_file_range)
+
+
+def _check_tar_members(tar, directory):
+    """Raise a tarfile.TarError if any member of an open tar archive would be extracted outside directory,
+    either directly or through a symbolic or hard link, like the command line tar refuses to do."""
+    root = os.path.realpath(directory)
+    for member in tar.getmembers():
+        paths = [os.path.join(root, member.name)]
+        if member.issym():
+            paths.append(os.path.join(root, os.path.dirname(member.name), member.linkname))
+        elif member.islnk():
+            paths.append(os.path.join(root, member.linkname))
+        for path in paths:
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                raise tarfile.TarError('{member} would be extracted outside {directory}'.format(
+                    member=member.name, directory=directory))
+
+
+def _extract_tar(path):
+    """Extract a .tar.gz archive into the directory that contains it, and then remove the archive."""
+    directory = os.path.dirname(path)
+    with tarfile.open(path, 'r:gz') as tar:
+        # match the command line tar and refuse to extract outside the directory; Pythons without
+        # extraction filters would follow absolute and .. member paths, so check the members first there
+        if hasattr(tarfile, 'tar_filter'):
+            tar.extraction_filter = tarfile.tar_filter
+        else:
+            _check_tar_members(tar, directory)
+        tar.extractall(directory)
+    # we don't want to save the tar archive
+    os.remove(path)
+
+
+def _extract_tars(paths):
+    """Extract a list of .tar.gz archives one at a time, in order."""
+    for path in paths:
+        _extract_tar(path)
+
+
+def _gunzip(path):
+    """Decompress a .gz file next to itself, keeping its permissions and modification time like gunzip does,
+    and then remove the compressed file."""
+    uncompressed_path = path[:-len('.gz')]
+    with gzip.open(path, 'rb') as f_in, open(uncompressed_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    shutil.copystat(path, uncompressed_path)
+    os.remove(path)
+
+
+def uncompress(directory, max_workers=None):
+    """Uncompress a directory by walking the directory tree. Files that were inside a tar archive
+    are also uncompressed, since the directories that archives were extracted into are walked again.
+
+    Files are decompressed in-process in a thread pool; zlib releases the GIL, so independent files
+    are decompressed in parallel.
+    """
+    directories = [directory]
+    while len(directories) > 0:
+        # walk through the directories and find anything that needs to be uncompressed
+        tar_paths = []
+        gz_paths = []
+        for walk_directory in directories:
+            for entry in _walk_files(walk_directory):
+                if entry.name.endswith(".tar.gz"):
+                    tar_paths.append(entry.path)
+                elif entry.name.endswith(".txt.gz"):
+                    gz_paths.append(entry.path)
+
+        # archives extracted into the same directory may share member paths, so those are extracted one at a
+        # time in walk order, and the same archive always wins
+        tar_paths_by_directory = defaultdict(list)
+        for path in tar_paths:
+            tar_paths_by_directory[os.path.dirname(path)].append(path)
+
+        if len(tar_paths) + len(gz_paths) > 0:
+            with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+                futures = [executor.submit(_extract_tars, paths) for paths in tar_paths_by_directory.values()]
+                futures += [executor.submit(_gunzip, path) for path in gz_paths]
+                for future in futures:
+                    future.result()
+
+        # only the directories that archives were extracted into can contain new compressed files;
+        # skip any that are inside another one, since walking that one already covers them
+        directories = []
+        for extracted_directory in sorted(tar_paths_by_directory, key=len):
+            if not any(extracted_directory.startswith(os.path.join(x, '')) for x in directories):
+                directories.append(extracted_directory)
 
 
 def clean_up(directory):
     # set permissions to read- and execute-only by user and group (0550)
     mode = S_IRUSR | S_IXUSR | S_IRGRP | S_IXGRP
-    for root, dirs, files in os.walk(directory):
+    # names are changed relative to each directory's file descriptor, so no full paths need to be resolved
+    for root, dirs, files, root_fd in os.fwalk(directory):
         for name in files:
-            os.chmod(os.path.join(root, name), mode)
+            os.chmod(name, mode, dir_fd=root_fd)
         for d in dirs:
-            os.chmod(os.path.join(root, d), mode)
+            os.chmod(d, mode, dir_fd=root_fd)
 
     # change permission on root itself
     os.chmod(directory, mode)
@@ -577,6 +931,8 @@ if __name__ == '__main__':
     parser.add_argument('--phs', default=None, type=int)
     parser.add_argument('--consent-variable', type=str, default=None,
                         help='name of consent variable in Subject file, otherwise assumed to be the third column')
+    parser.add_argument('--hardlink', default=False, action='store_true',
+                        help='hard link downloaded files into the raw directory instead of copying them')
     args = parser.parse_args()
 
     # check arguments
@@ -611,7 +967,7 @@ if __name__ == '__main__':
 
     print("copying files...")
     # copy files to the final "raw" directory
-    copy_files(directory, raw_directory)
+    copy_files(directory, raw_directory, hardlink=args.hardlink)
 
     print("uncompressing files...")
     uncompress(raw_directory)
@@ -1,12 +1,19 @@
-#! /usr/bin/env python3.4
+#! /usr/bin/env python3.6
 import unittest
 import os
 import tempfile
 import shutil
 import subprocess
 import glob
+import re
+import errno
+import tarfile as tar_module
+import time
+import types
+from unittest import mock
 
 from faker import Factory
+import pandas as pd
 
 import organize_dbgap
 # classes
@@ -87,41 +94,21 @@ def _get_test_dbgap_filename(file_type, **kwargs):
 class GetTestDbgapFilenameTestCase(unittest.TestCase):
     """Tests for the helper function _get_test_dbgap_filename"""
 
-    def test_phenotype(self):
-        """DbgapFile objects have correct file_type for test phenotype files"""
-        filename = _get_test_dbgap_filename('phenotype')
-        dbgap_file = DbgapFile(filename, check_exists=False)
-        self.assertEqual(dbgap_file.file_type, 'phenotype')
-
-    def test_var_report(self):
-        """DbgapFile objects have correct file_type for test var_report files"""
-        filename = _get_test_dbgap_filename('var_report')
-        dbgap_file = DbgapFile(filename, check_exists=False)
-        self.assertEqual(dbgap_file.file_type, 'var_report')
-
-    def test_data_dict(self):
-        """DbgapFile objects have correct file_type for test data_dict files"""
-        filename = _get_test_dbgap_filename('data_dict')
-        dbgap_file = DbgapFile(filename, check_exists=False)
-        self.assertEqual(dbgap_file.file_type, 'data_dict')
-
-    def test_subject(self):
-        """DbgapFile objects have correct file_type for test subject files"""
-        filename = _get_test_dbgap_filename('subject')
-        dbgap_file = DbgapFile(filename, check_exists=False)
-        self.assertEqual(dbgap_file.file_type, 'special')
-
-    def test_pedigree(self):
-        """DbgapFile objects have correct file_type for test pedigree files"""
-        filename = _get_test_dbgap_filename('pedigree')
-        dbgap_file = DbgapFile(filename, check_exists=False)
-        self.assertEqual(dbgap_file.file_type, 'special')
-
-    def test_sample(self):
-        """DbgapFile objects have correct file_type for test sample files"""
-        filename = _get_test_dbgap_filename('sample')
-        dbgap_file = DbgapFile(filename, check_exists=False)
-        self.assertEqual(dbgap_file.file_type, 'special')
+    def test_file_types(self):
+        """DbgapFile objects have correct file_type for each kind of test file"""
+        expected = (
+            ('phenotype', 'phenotype'),
+            ('var_report', 'var_report'),
+            ('data_dict', 'data_dict'),
+            ('subject', 'special'),
+            ('pedigree', 'special'),
+            ('sample', 'special'),
+        )
+        for test_type, file_type in expected:
+            with self.subTest(test_type=test_type):
+                filename = _get_test_dbgap_filename(test_type)
+                dbgap_file = DbgapFile(filename, check_exists=False)
+                self.assertEqual(dbgap_file.file_type, file_type)
 
 
 class TempdirTestCase(unittest.TestCase):
@@ -140,6 +127,14 @@ class TempdirTestCase(unittest.TestCase):
 class TestDbgapFile(TempdirTestCase):
     """TestCase class for DbgapFile class"""
 
+    # alternative regex pattern dictionary for the test_with_different_regex test
+    different_re_dict = {
+        'phenotype': '^phenotype.txt$',
+        'data_dict': '^data_dict.txt$',
+        'var_report': '^var_report.txt$',
+        'special': '^special.txt$',
+    }
+
     def test_str(self):
         """test that str method returns a string"""
         filename = os.path.join(self.tempdir, 'testfile.xml')
@@ -147,29 +142,21 @@ class TestDbgapFile(TempdirTestCase):
         dbgap_file = DbgapFile(filename)
         self.assertIsInstance(dbgap_file.__str__(), str)
 
-    def test_get_file_type_phenotype(self):
-        """DbgapFile._set_file_type works correctly for phenotoype files"""
-        filename = os.path.join(self.tempdir, 'phs000284.v1.pht001903.v1.p1.c1.CFS_CARe_ECG.NPU.txt')
-        _touch(filename)
-        dbgap_file = DbgapFile(filename)
-        self.assertEqual(dbgap_file.file_type, 'phenotype')
-        self.assertEqual(dbgap_file.match.groupdict()['dbgap_id'], 'phs000284.v1.pht001903.v1')
-
-    def test_get_file_type_data_dict(self):
-        """DbgapFile._set_file_type works correctly for data_dict files"""
-        filename = os.path.join(self.tempdir, 'phs000284.v1.pht001903.v1.CFS_CARe_ECG.data_dict_2011_02_07.xml')
-        _touch(filename)
-        dbgap_file = DbgapFile(filename)
-        self.assertEqual(dbgap_file.file_type, 'data_dict')
-        self.assertEqual(dbgap_file.match.groupdict()['dbgap_id'], 'phs000284.v1.pht001903.v1')
-
-    def test_get_file_type_var_report(self):
-        """DbgapFile._set_file_type works correctly for var_report files"""
-        filename = os.path.join(self.tempdir, 'phs000284.v1.pht001903.v1.p1.CFS_CARe_ECG.var_report_2011_02_07.xml')
-        _touch(filename)
-        dbgap_file = DbgapFile(filename)
-        self.assertEqual(dbgap_file.file_type, 'var_report')
-        self.assertEqual(dbgap_file.match.groupdict()['dbgap_id'], 'phs000284.v1.pht001903.v1')
+    def test_get_file_type(self):
+        """DbgapFile._set_file_type works correctly for phenotype, data_dict, and var_report files"""
+        expected = (
+            ('phs000284.v1.pht001903.v1.p1.c1.CFS_CARe_ECG.NPU.txt', 'phenotype'),
+            ('phs000284.v1.pht001903.v1.CFS_CARe_ECG.data_dict_2011_02_07.xml', 'data_dict'),
+            ('phs000284.v1.pht001903.v1.p1.CFS_CARe_ECG.var_report_2011_02_07.xml', 'var_report'),
+        )
+        for basename, file_type in expected:
+            with self.subTest(file_type=file_type):
+                filename = os.path.join(self.tempdir, basename)
+                _touch(filename)
+                dbgap_file = DbgapFile(filename)
+                self.assertEqual(dbgap_file.file_type, file_type)
+                self.assertEqual(dbgap_file.match.groupdict()['dbgap_id'], 'phs000284.v1.pht001903.v1')
+                self.assertEqual(dbgap_file.dbgap_id, 'phs000284.v1.pht001903.v1')
 
     def test_get_file_type_other(self):
         """DbgapFile._set_file_type works correctly for files that don't match a regex"""
@@ -178,6 +165,7 @@ class TestDbgapFile(TempdirTestCase):
         dbgap_file = DbgapFile(filename)
         self.assertIsNone(dbgap_file.file_type)
         self.assertIsNone(dbgap_file.match)
+        self.assertIsNone(dbgap_file.dbgap_id)
 
     def test_exception_file_not_found(self):
         """is an exception raised when the file is not found?"""
@@ -191,63 +179,116 @@ class TestDbgapFile(TempdirTestCase):
         # this should not crash
         dbgap_file = DbgapFile(filename, check_exists=False)
 
-    def test_with_different_regex_phenotype(self):
-        """test that DbgapFile._set_file_type works with a different regex pattern dictionary for phentoype files"""
-        filename = os.path.join(self.tempdir, 'phenotype.txt')
-        _touch(filename)
-        dbgap_file = DbgapFile(filename)
+    def test_with_different_regex(self):
+        """test that DbgapFile._set_file_type works with a different regex pattern dictionary for each file type"""
+        for file_type in ('phenotype', 'data_dict', 'var_report', 'special'):
+            with self.subTest(file_type=file_type):
+                filename = os.path.join(self.tempdir, '{file_type}.txt'.format(file_type=file_type))
+                _touch(filename)
+                dbgap_file = DbgapFile(filename)
+                dbgap_file._set_file_type(re_dict=self.different_re_dict)
+                self.assertEqual(dbgap_file.file_type, file_type)
+
+    def test_first_matching_pattern_is_used(self):
+        """test that the first matching pattern in re_dict sets the file_type"""
+        dbgap_file = DbgapFile('special.txt', check_exists=False)
         re_dict = {
-            'phenotype': '^phenotype.txt$',
-            'data_dict': '^data_dict.txt$',
-            'var_report': '^var_report.txt$',
+            'phenotype': '^special.txt$',
             'special': '^special.txt$',
         }
         dbgap_file._set_file_type(re_dict=re_dict)
         self.assertEqual(dbgap_file.file_type, 'phenotype')
 
-    def test_with_different_regex_data_dict(self):
-        """test that DbgapFile._set_file_type works with a different regex pattern dictionary for data dict files"""
-        filename = os.path.join(self.tempdir, 'data_dict.txt')
-        _touch(filename)
-        dbgap_file = DbgapFile(filename)
-        re_dict = {
-            'phenotype': '^phenotype.txt$',
-            'data_dict': '^data_dict.txt$',
-            'var_report': '^var_report.txt$',
-            'special': '^special.txt$',
-        }
-        dbgap_file._set_file_type(re_dict=re_dict)
-        self.assertEqual(dbgap_file.file_type, 'data_dict')
-
-    def test_with_different_regex_var_report(self):
-        """test that DbgapFile._set_file_type works with a different regex pattern dictionary for var_report files"""
-        filename = os.path.join(self.tempdir, 'var_report.txt')
-        _touch(filename)
-        dbgap_file = DbgapFile(filename)
-        re_dict = {
-            'phenotype': '^phenotype.txt$',
-            'data_dict': '^data_dict.txt$',
-            'var_report': '^var_report.txt$',
-            'special': '^special.txt$',
-        }
-        dbgap_file._set_file_type(re_dict=re_dict)
-        self.assertEqual(dbgap_file.file_type, 'var_report')
-
-    def test_with_different_regex_special(self):
-        """test that DbgapFile._set_file_type works with a different regex pattern dictionary for special files"""
+    def test_with_different_compiled_regex(self):
+        """test that DbgapFile._set_file_type works with a dictionary of compiled regex patterns"""
         filename = os.path.join(self.tempdir, 'special.txt')
         _touch(filename)
         dbgap_file = DbgapFile(filename)
         re_dict = {
-            'phenotype': '^phenotype.txt$',
-            'data_dict': '^data_dict.txt$',
-            'var_report': '^var_report.txt$',
-            'special': '^special.txt$',
+            'phenotype': re.compile('^phenotype.txt$'),
+            'special': re.compile('^special.txt$'),
         }
         dbgap_file._set_file_type(re_dict=re_dict)
         self.assertEqual(dbgap_file.file_type, 'special')
 
 
+class ClassifyTestCase(unittest.TestCase):
+    """Tests for _classify function"""
+
+    def test_working(self):
+        """test that _classify returns the file type and match for a dbgap file name"""
+        basename = 'phs000284.v1.pht001903.v1.p1.c1.CFS_CARe_ECG.NPU.txt'
+        file_type, match = organize_dbgap._classify(basename)
+        self.assertEqual(file_type, 'phenotype')
+        self.assertEqual(match.group('dbgap_id'), 'phs000284.v1.pht001903.v1')
+
+    def test_special_file_that_also_matches_phenotype(self):
+        """test that _classify returns 'special' for MULTI file names that also match the phenotype pattern"""
+        for basename in ('phs000001.v1.pht000001.v1.p1.c1.Subject.MULTI.txt',
+                         'phs000001.v1.pht000001.v1.p1.c1.Foo_Pedigree.MULTI.txt'):
+            with self.subTest(basename=basename):
+                self.assertEqual(organize_dbgap._classify(basename)[0], 'special')
+
+    def test_no_match(self):
+        """test that _classify returns None for file names that don't match any pattern"""
+        self.assertEqual(organize_dbgap._classify('README.txt'), (None, None))
+        self.assertEqual(organize_dbgap._classify('phs000284.v1.pht001903.v1.p1.c1.CFS_CARe_ECG.NPU.txt.gz'),
+                         (None, None))
+
+
+class CompileReDictTestCase(unittest.TestCase):
+    """Tests for _compile_re_dict function"""
+
+    def test_working(self):
+        """test that pattern strings are compiled, compiled patterns are kept, and the order is preserved"""
+        compiled = re.compile('^special.txt$')
+        re_items = (('phenotype', '^phenotype.txt$'), ('special', compiled))
+        result = organize_dbgap._compile_re_dict(re_items)
+        self.assertEqual([key for key, pattern in result], ['phenotype', 'special'])
+        self.assertEqual(result[0][1].pattern, '^phenotype.txt$')
+        self.assertIs(result[1][1], compiled)
+
+
+class ScanDirectoryTestCase(TempdirTestCase):
+    """class to hold tests for _scan_directory function"""
+
+    def test_working(self):
+        """are subdirectories and files in a single directory returned separately?"""
+        subdir = os.path.join(self.tempdir, 'dir1')
+        os.mkdir(subdir)
+        _touch(os.path.join(subdir, 'file2.txt'))
+        file1 = os.path.join(self.tempdir, 'file1.txt')
+        _touch(file1)
+        subdirectories, files = organize_dbgap._scan_directory(self.tempdir)
+        self.assertEqual(subdirectories, [subdir])
+        self.assertEqual([entry.path for entry in files], [file1])
+
+
+class WalkFilesTestCase(TempdirTestCase):
+    """class to hold tests for _walk_files function"""
+
+    def test_finds_files_in_subdirectories(self):
+        """are files in nested subdirectories found, and directories skipped?"""
+        subdir = os.path.join(self.tempdir, 'dir1', 'dir2')
+        os.makedirs(subdir)
+        file1 = os.path.join(self.tempdir, 'file1.txt')
+        _touch(file1)
+        file2 = os.path.join(subdir, 'file2.txt')
+        _touch(file2)
+        paths = [entry.path for entry in organize_dbgap._walk_files(self.tempdir)]
+        self.assertEqual(sorted(paths), sorted([file1, file2]))
+
+    def test_does_not_follow_directory_symlinks(self):
+        """are symlinks to directories skipped, as in os.walk?"""
+        subdir = os.path.join(self.tempdir, 'dir1')
+        os.mkdir(subdir)
+        file1 = os.path.join(subdir, 'file1.txt')
+        _touch(file1)
+        os.symlink(subdir, os.path.join(self.tempdir, 'link'))
+        paths = [entry.path for entry in organize_dbgap._walk_files(self.tempdir)]
+        self.assertEqual(paths, [file1])
+
+
 class GetFileListTestCase(TempdirTestCase):
     """class to hold tests for _get_file_list function"""
 
@@ -264,6 +305,27 @@ class GetFileListTestCase(TempdirTestCase):
             self.assertIsInstance(x, DbgapFile)
 
 
+class GetDigestTestCase(TempdirTestCase):
+    """class to hold tests for _get_digest function"""
+
+    def test_same_digest_for_same_contents(self):
+        """do files with the same contents have the same digest?"""
+        text = fake.text()
+        file1 = os.path.join(self.tempdir, 'file1.txt')
+        file2 = os.path.join(self.tempdir, 'file2.txt')
+        _touch(file1, text=text)
+        _touch(file2, text=text)
+        self.assertEqual(organize_dbgap._get_digest(file1), organize_dbgap._get_digest(file2))
+
+    def test_digest_updated_if_file_changes(self):
+        """is the digest recomputed if a file changes after it was first hashed?"""
+        file1 = os.path.join(self.tempdir, 'file1.txt')
+        _touch(file1, text='a')
+        digest = organize_dbgap._get_digest(file1)
+        _touch(file1, text='ab')
+        self.assertNotEqual(organize_dbgap._get_digest(file1), digest)
+
+
 class CheckDiffsTestCase(TempdirTestCase):
     """class to hold tests for _check_diffs function"""
 
@@ -298,6 +360,53 @@ class CheckDiffsTestCase(TempdirTestCase):
         with self.assertRaises(ValueError):
             organize_dbgap._check_diffs(dbgap_files)
 
+    def test_exception_with_diff_of_same_size(self):
+        """Does _check_diffs raise a ValueError exception if the files are different but the same size?"""
+        file1 = os.path.join(self.tempdir, 'file1.txt')
+        file2 = os.path.join(self.tempdir, 'file2.txt')
+        with open(file1, 'w') as f:
+            f.write('abc')
+        with open(file2, 'w') as f:
+            f.write('abd')
+        dbgap_files = organize_dbgap.get_file_list(self.tempdir)
+        with self.assertRaises(ValueError):
+            organize_dbgap._check_diffs(dbgap_files)
+
+
+class GroupByFileTypeTestCase(unittest.TestCase):
+    """Class to hold tests for _group_by_file_type function"""
+
+    def test_working(self):
+        """does it group files by file_type, with unclassified files under None?"""
+        dd = DbgapFile(_get_test_dbgap_filename('data_dict'), check_exists=False)
+        phenotype1 = DbgapFile(_get_test_dbgap_filename('phenotype'), check_exists=False)
+        phenotype2 = DbgapFile(_get_test_dbgap_filename('phenotype'), check_exists=False)
+        other = DbgapFile(_get_test_dbgap_filename('other'), check_exists=False)
+        files_by_type = organize_dbgap._group_by_file_type([dd, phenotype1, other, phenotype2])
+        self.assertEqual(files_by_type['data_dict'], [dd])
+        self.assertEqual(files_by_type['phenotype'], [phenotype1, phenotype2])
+        self.assertEqual(files_by_type[None], [other])
+        self.assertEqual(files_by_type['var_report'], [])
+
+
+class IndexFileListTestCase(unittest.TestCase):
+    """Class to hold tests for _index_file_list function"""
+
+    def test_working(self):
+        """does it index files by file_type and dbgap_id?"""
+        filename = _get_test_dbgap_filename('data_dict', phs=7, phs_v=1, pht=1, pht_v=1)
+        dd1 = DbgapFile(filename, check_exists=False)
+        filename = _get_test_dbgap_filename('data_dict', phs=7, phs_v=1, pht=2, pht_v=1)
+        dd2 = DbgapFile(filename, check_exists=False)
+        filename = _get_test_dbgap_filename('phenotype', phs=7, phs_v=1, pht=1, pht_v=1)
+        phenotype = DbgapFile(filename, check_exists=False)
+        other = DbgapFile(_get_test_dbgap_filename('other'), check_exists=False)
+        file_index = organize_dbgap._index_file_list([dd1, dd2, phenotype, other])
+        self.assertEqual(file_index[('data_dict', 'phs000007.v1.pht000001.v1')], [dd1])
+        self.assertEqual(file_index[('data_dict', 'phs000007.v1.pht000002.v1')], [dd2])
+        self.assertEqual(file_index[('phenotype', 'phs000007.v1.pht000001.v1')], [phenotype])
+        self.assertEqual(len(file_index), 3)
+
 
 class GetFileMatchTestCase(TempdirTestCase):
     """Class to hold tests for _get_file_match function"""
@@ -337,6 +446,18 @@ class GetFileMatchTestCase(TempdirTestCase):
         files = [other_file, file_to_match]
         self.assertIsNone(organize_dbgap._get_file_match(files, file_to_match, 'data_dict', must_exist=False))
 
+    def test_working_with_file_index(self):
+        """does it properly match files using a precomputed file index?"""
+        filename = _get_test_dbgap_filename('data_dict', phs=7, phs_v=1, pht=1, pht_v=1)
+        xml_file = DbgapFile(filename, check_exists=False)
+        filename = _get_test_dbgap_filename('phenotype', phs=7, phs_v=1, pht=1, pht_v=1)
+        file_to_match = DbgapFile(filename, check_exists=False)
+        files = [xml_file, file_to_match]
+        file_index = organize_dbgap._index_file_list(files)
+        self.assertEqual(organize_dbgap._get_file_match(files, file_to_match, 'data_dict', check_diffs=False,
+                                                        file_index=file_index),
+                         xml_file)
+
     def test_working_var_report(self):
         """does it properly match var_reports?"""
         phs = 7
@@ -544,6 +665,25 @@ class DbgapDirectoryStructureTestCase(TempdirTestCase):
         super(DbgapDirectoryStructureTestCase, self).tearDown()
 
 
+class GroupSpecialFilesTestCase(DbgapDirectoryStructureTestCase):
+
+    def test_working(self):
+        """test that _group_special_files groups special files by pattern"""
+        self._make_file_set('phenotype')
+        self._make_file_set('subject')
+        subject_files = [self.data_file1, self.data_file2]
+        self._make_file_set('sample')
+        sample_files = [self.data_file1, self.data_file2]
+        dbgap_files = organize_dbgap.get_file_list(self.tempdir)
+        special_files = organize_dbgap._group_special_files(dbgap_files)
+        self.assertEqual(sorted(special_files.keys()), ['Pedigree', 'Sample', 'Subject'])
+        self.assertEqual(sorted(f.full_path for f in special_files['Subject']),
+                         sorted(f.full_path for f in subject_files))
+        self.assertEqual(sorted(f.full_path for f in special_files['Sample']),
+                         sorted(f.full_path for f in sample_files))
+        self.assertEqual(special_files['Pedigree'], [])
+
+
 class GetSpecialFileSetTestCase(DbgapDirectoryStructureTestCase):
 
     def test_working_with_subject_pattern(self):
@@ -738,11 +878,31 @@ class MakeSymlinkTestCase(TempdirTestCase):
         organize_dbgap._make_symlink(self.dbgap_file)
         self.assertTrue(os.path.exists(self.basename))
 
+    def test_working_with_directory_and_dir_fd(self):
+        """test that symlinks are properly created in another directory using a directory file descriptor"""
+        directory = os.path.join(self.tempdir, self.subdir)
+        with organize_dbgap._open_directory(directory) as dir_fd:
+            organize_dbgap._make_symlink(self.dbgap_file, directory=directory, dir_fd=dir_fd)
+        symlink_path = os.path.join(directory, self.basename)
+        self.assertTrue(os.path.exists(symlink_path))
+        self.assertFalse(os.path.isabs(os.readlink(symlink_path)))
+        self.assertEqual(os.getcwd(), self.original_directory)
+
+    def test_symlink_target_is_relative_path(self):
+        """test that the symlink target is the relative path from the symlink directory to the file"""
+        directory = os.path.join(self.tempdir, self.subdir)
+        organize_dbgap._make_symlink(self.dbgap_file, directory=directory)
+        target = os.readlink(os.path.join(directory, self.basename))
+        self.assertEqual(target, os.path.relpath(self.full_path, directory))
+
     def test_exception_if_path_does_not_exist(self):
         """Test that _make_symlink raises an exception if the requested file is not found"""
         os.remove(self.dbgap_file.full_path)
+        directory = os.path.join(self.tempdir, self.subdir)
         with self.assertRaises(FileNotFoundError):
-            organize_dbgap._make_symlink(self.dbgap_file)
+            organize_dbgap._make_symlink(self.dbgap_file, directory=directory)
+        # no broken symlink is left behind
+        self.assertFalse(os.path.lexists(os.path.join(directory, self.basename)))
 
 
 class MakeSymlinkSetTestCase(DbgapDirectoryStructureTestCase):
@@ -813,6 +973,17 @@ class UncompressTestCase(TempdirTestCase):
         self.assertTrue(os.path.exists(os.path.join(self.tempdir, filename)))
         self.assertFalse(os.path.exists(os.path.join(self.tempdir, filename + ".gz")))
 
+    def test_gzipped_txt_file_contents_are_kept(self):
+        """Test that uncompress keeps the contents of an unzipped .txt.gz file"""
+        filename = os.path.join(self.tempdir, fake.file_name(extension="txt"))
+        text = fake.text()
+        _touch(filename, text=text)
+        cmd = 'gzip {file}'.format(file=filename)
+        subprocess.check_call(cmd, shell=True)
+        organize_dbgap.uncompress(self.tempdir)
+        with open(filename) as f:
+            self.assertEqual(f.read(), text)
+
     def test_non_txt_gzipped_file_still_compressed(self):
         """Test that uncompress does not unzip a non-.txt.gz file"""
         filename = os.path.join(self.tempdir, fake.file_name(extension="png"))
@@ -893,6 +1064,81 @@ class UncompressTestCase(TempdirTestCase):
         self.assertTrue(os.path.exists(os.path.join(self.tempdir, file2)))
         self.assertFalse(os.path.exists(os.path.join(self.tempdir, tarfile)))
 
+    def test_tar_files_in_the_same_directory_are_extracted_one_at_a_time(self):
+        """test that uncompress extracts tar files that share a directory serially, in walk order"""
+        for i in range(4):
+            member_path = os.path.join(self.tempdir, fake.file_name(extension="txt"))
+            _touch(member_path)
+            with tar_module.open(os.path.join(self.tempdir, 'archive{i}.tar.gz'.format(i=i)), 'w:gz') as tar:
+                tar.add(member_path, arcname=os.path.basename(member_path))
+            os.remove(member_path)
+        walk_order = [entry.path for entry in os.scandir(self.tempdir)]
+        extract_tar = organize_dbgap._extract_tar
+        extracted = []
+        active = []
+
+        def _extract_tar(path):
+            active.append(path)
+            self.assertEqual(len(active), 1)
+            time.sleep(0.05)
+            extract_tar(path)
+            extracted.append(path)
+            active.remove(path)
+
+        with mock.patch.object(organize_dbgap, '_extract_tar', _extract_tar):
+            organize_dbgap.uncompress(self.tempdir, max_workers=4)
+        self.assertEqual(extracted, walk_order)
+
+    def _make_tar_with_member_outside(self, directory):
+        """Make a .tar.gz file in directory with a member that would be extracted into its parent directory"""
+        member_path = os.path.join(self.tempdir, fake.file_name(extension="txt"))
+        _touch(member_path)
+        tar_path = os.path.join(directory, fake.file_name(extension='tar.gz'))
+        with tar_module.open(tar_path, 'w:gz') as tar:
+            tar.add(member_path, arcname=os.path.join('..', os.path.basename(member_path) + '.outside'))
+        return tar_path, member_path + '.outside'
+
+    def test_member_outside_directory_is_not_extracted(self):
+        """test that uncompress refuses to extract a tar member outside the directory holding the archive"""
+        subdir = os.path.join(self.tempdir, fake.word())
+        os.mkdir(subdir)
+        tar_path, outside_path = self._make_tar_with_member_outside(subdir)
+        with self.assertRaises(tar_module.TarError):
+            organize_dbgap.uncompress(subdir)
+        self.assertFalse(os.path.exists(outside_path))
+
+    def test_member_outside_directory_is_not_extracted_without_extraction_filters(self):
+        """test that uncompress refuses to extract a tar member outside the directory on Pythons without
+        tarfile extraction filters"""
+        subdir = os.path.join(self.tempdir, fake.word())
+        os.mkdir(subdir)
+        tar_path, outside_path = self._make_tar_with_member_outside(subdir)
+        with mock.patch.object(organize_dbgap, 'tarfile', types.SimpleNamespace(open=tar_module.open, TarError=tar_module.TarError)):
+            with self.assertRaises(tar_module.TarError):
+                organize_dbgap.uncompress(subdir)
+        self.assertFalse(os.path.exists(outside_path))
+
+    def test_recursive_with_tar_files_in_nested_directories(self):
+        """test that uncompress works recursively when tar files are in both a directory and its subdirectory"""
+        subdir = fake.word()
+        os.mkdir(os.path.join(self.tempdir, subdir))
+        filenames = []
+        for directory in (self.tempdir, os.path.join(self.tempdir, subdir)):
+            os.chdir(directory)
+            filename = fake.file_name(extension="txt")
+            _touch(filename)
+            subprocess.check_call('gzip {file}'.format(file=filename), shell=True)
+            tarfile = fake.file_name(extension='tar.gz')
+            cmd = 'tar -czf {tarfile} {file}'.format(tarfile=tarfile, file=filename + '.gz')
+            subprocess.check_call(cmd, shell=True)
+            os.remove(filename + '.gz')
+            filenames.append(os.path.join(directory, filename))
+        os.chdir(self.original_directory)
+        organize_dbgap.uncompress(self.tempdir)
+        for filename in filenames:
+            self.assertTrue(os.path.exists(filename))
+            self.assertFalse(os.path.exists(filename + '.gz'))
+
 
 class CreateFinalDirectoryTestCase(TempdirTestCase):
     """Tests for create_final_directory function"""
@@ -972,6 +1218,45 @@ class CheckConsentGroupsTestCase(DbgapDirectoryStructureTestCase):
         with self.assertRaisesRegex(KeyError, 'Expected consent variable CONSENT'):
             organize_dbgap._check_consent_groups(subject_set, phenotype_sets, consent_variable="CONSENT")
 
+    def test_works_with_quoted_header(self):
+        lines = '\n'.join([
+            '# a comment',
+            '"dbGaP_Subject_ID"\t"SUBJECT_ID"\t"CONSENT"',
+            '1001\t1\t1',
+            '1002\t2\t2',
+            '1003\t3\t1',
+            '1004\t4\t2',
+            ''
+        ])
+        for x in glob.iglob(os.path.join(self.dir2, "*.Subject.MULTI.txt")):
+            _touch(x, text=lines)
+        for x in glob.iglob(os.path.join(self.dir1, "*.Subject.MULTI.txt")):
+            _touch(x, text=lines)
+        dbgap_files = organize_dbgap.get_file_list(self.tempdir)
+        subject_set = organize_dbgap._get_special_file_set(dbgap_files, pattern='Subject')
+        phenotype_sets = organize_dbgap._get_phenotype_file_sets(dbgap_files)
+        self.assertIsNone(organize_dbgap._check_consent_groups(subject_set, phenotype_sets,
+                                                               consent_variable="CONSENT"))
+
+    def test_parse_error_is_not_reported_as_missing_consent_variable(self):
+        # Create a subject file with a data row that has too many fields.
+        lines = '\n'.join([
+            '# a comment',
+            'dbGaP_Subject_ID\tSUBJECT_ID\tCONSENT',
+            '1001\t1\t1',
+            '1002\t2\t2\t1\t1',
+            ''
+        ])
+        for x in glob.iglob(os.path.join(self.dir2, "*.Subject.MULTI.txt")):
+            _touch(x, text=lines)
+        for x in glob.iglob(os.path.join(self.dir1, "*.Subject.MULTI.txt")):
+            _touch(x, text=lines)
+        dbgap_files = organize_dbgap.get_file_list(self.tempdir)
+        subject_set = organize_dbgap._get_special_file_set(dbgap_files, pattern='Subject')
+        phenotype_sets = organize_dbgap._get_phenotype_file_sets(dbgap_files)
+        with self.assertRaises(pd.errors.ParserError):
+            organize_dbgap._check_consent_groups(subject_set, phenotype_sets, consent_variable="CONSENT")
+
     def test_fails_with_too_few_phenotype_files(self):
         # Remove one of the directories and try again.
         shutil.rmtree(self.dir2)
@@ -1213,6 +1498,81 @@ class CopyFilesTestCase(TempdirTestCase):
         with self.assertRaises(Exception):
             organize_dbgap.copy_files(subdir1, subdir2)
 
+    def test_contents_are_copied(self):
+        """test that copy_files copies file contents into a separate file"""
+        os.chdir(self.tempdir)
+        subdir1 = fake.word()
+        os.mkdir(subdir1)
+        filename = fake.file_name()
+        text = fake.text()
+        _touch(os.path.join(subdir1, filename), text=text)
+        subdir2 = fake.word() + '_copy'
+        organize_dbgap.copy_files(subdir1, subdir2)
+        with open(os.path.join(subdir2, filename)) as f:
+            self.assertEqual(f.read(), text)
+        self.assertFalse(os.path.samefile(os.path.join(subdir1, filename), os.path.join(subdir2, filename)))
+
+    def test_contents_are_copied_if_copy_file_range_copies_nothing(self):
+        """test that copy_files falls back to a regular copy if copy_file_range reports end of file at once"""
+        os.chdir(self.tempdir)
+        subdir1 = fake.word()
+        os.mkdir(subdir1)
+        filename = fake.file_name()
+        text = fake.text()
+        _touch(os.path.join(subdir1, filename), text=text)
+        subdir2 = fake.word() + '_copy'
+        with mock.patch('os.copy_file_range', return_value=0, create=True):
+            organize_dbgap.copy_files(subdir1, subdir2)
+        with open(os.path.join(subdir2, filename)) as f:
+            self.assertEqual(f.read(), text)
+
+    def test_contents_are_copied_if_copy_file_range_fails(self):
+        """test that copy_files falls back to a regular copy if copy_file_range raises an error"""
+        os.chdir(self.tempdir)
+        subdir1 = fake.word()
+        os.mkdir(subdir1)
+        filename = fake.file_name()
+        text = fake.text()
+        _touch(os.path.join(subdir1, filename), text=text)
+        subdir2 = fake.word() + '_copy'
+        with mock.patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'cross-device'), create=True):
+            organize_dbgap.copy_files(subdir1, subdir2)
+        with open(os.path.join(subdir2, filename)) as f:
+            self.assertEqual(f.read(), text)
+
+    def test_hardlink(self):
+        """test that copy_files hard links files when hardlink is True"""
+        os.chdir(self.tempdir)
+        subdir1 = fake.word()
+        os.mkdir(subdir1)
+        filename = fake.file_name()
+        _touch(os.path.join(subdir1, filename))
+        subdir2 = fake.word() + '_copy'
+        organize_dbgap.copy_files(subdir1, subdir2, hardlink=True)
+        self.assertTrue(os.path.samefile(os.path.join(subdir1, filename), os.path.join(subdir2, filename)))
+
+
+class CleanUpTestCase(TempdirTestCase):
+    """Tests of clean_up function"""
+
+    def tearDown(self):
+        # restore write permissions so that the temporary directory can be removed
+        for root, dirs, files in os.walk(self.tempdir):
+            for d in dirs:
+                os.chmod(os.path.join(root, d), 0o755)
+        super(CleanUpTestCase, self).tearDown()
+
+    def test_working(self):
+        """test that clean_up sets permissions on the directory, its subdirectories, and its files"""
+        directory = os.path.join(self.tempdir, fake.word())
+        subdir = os.path.join(directory, fake.word())
+        os.makedirs(subdir)
+        filename = os.path.join(subdir, fake.file_name())
+        _touch(filename)
+        organize_dbgap.clean_up(directory)
+        for path in (directory, subdir, filename):
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o550)
+
 
 class OrganizeTestCase(DbgapDirectoryStructureTestCase):
     """Tests for organize function"""